@@ -2,16 +2,30 @@
 from __future__ import annotations
 
 import argparse
+import gzip
+import hashlib
+import heapq
 import json
 import os
 import re
+import threading
 import time
+from array import array
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from itertools import chain
 from urllib.parse import urlencode, parse_qs, urlparse
 
 # requests 대신 cloudscraper를 임포트합니다.
 import cloudscraper
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
+
+# orjson이 있으면 C 확장 인코더로 캐시를 쓰고, 없으면 표준 json으로 대체합니다.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 BASE = "https://royaleapi.com"
 
@@ -22,17 +36,43 @@ BATTLE_SELECTORS = [
     "div.battle__container",
 ]
 
-CARD_IMG_SELECTOR = "img.deck_card, img[data-card-key]"
+# lexbor는 콤마로 묶은 선택자 그룹에서 두 조건을 모두 만족하는 요소를 두 번 돌려주므로 :is()로 한 번만 매칭합니다.
+CARD_IMG_SELECTOR = "img:is(.deck_card, [data-card-key])"
 TEAM_SELECTORS = [
     "div.team-segment",
     "div.team_segment",
     "div.team",
 ]
+_CARD_SRC_RE = re.compile(r"/cards/([a-z0-9\-]+)/")
+_BEFORE_RE = re.compile(r"before=(\d+)")
+# 카드 키는 종류가 적고(수백 개 이하) 수천 번 반복되므로, 키마다 정수 id를 붙여
+# 덱을 문자열 리스트 대신 array("H")(카드당 2바이트)로 저장합니다.
+_CARD_IDS: dict[str, int] = {}
+_CARD_KEYS: list[str] = []
+# 매치 한 개 = (승리 덱 8장, 패배 덱 8장), 각 덱은 카드 id 배열
+Match = tuple[array, array]
 BLOCK_TEXT_MARKERS = (
     "just a moment",
     "cf-browser-verification",
     "checking your browser before accessing",
 )
+# 차단 페이지는 작고 마커가 항상 앞부분에 있으므로, 본문 전체를 lower() 하지 않고 앞부분만 검사합니다.
+BLOCK_SCAN_CHARS = 4096
+_BLOCK_RE = re.compile("|".join(map(re.escape, BLOCK_TEXT_MARKERS)), re.IGNORECASE)
+
+# 클라우드플레어 우회를 위한 cloudscraper 세션 (최신 윈도우 크롬 브라우저로 위장).
+# 하나만 만들어 재사용하면 keep-alive 연결, TLS 세션, 클라우드플레어 쿠키를 계속 쓸 수 있습니다.
+_SESSION = cloudscraper.create_scraper(
+    browser={
+        'browser': 'chrome',
+        'platform': 'windows',
+        'desktop': True
+    }
+)
+# User-Agent는 cloudscraper가 자동으로 알맞게 생성해주므로 Accept만 지정합니다.
+_SESSION.headers.update(
+    {"Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"}
+)
 
 
 def build_url(rank: int, lang: str, before: int | None) -> str:
@@ -43,39 +83,133 @@ def build_url(rank: int, lang: str, before: int | None) -> str:
 
 
 def looks_like_block_page(html: str) -> bool:
-    lower = html.lower()
-    return any(marker in lower for marker in BLOCK_TEXT_MARKERS)
+    return _BLOCK_RE.search(html, 0, BLOCK_SCAN_CHARS) is not None
 
 
-def fetch_html(url: str, *, max_attempts: int = 3, retry_delay: float = 1.0) -> str | None:
-    # 클라우드플레어 우회를 위한 cloudscraper 인스턴스 생성 (최신 윈도우 크롬 브라우저로 위장)
-    scraper = cloudscraper.create_scraper(
-        browser={
-            'browser': 'chrome',
-            'platform': 'windows',
-            'desktop': True
-        }
-    )
-    
-    # User-Agent는 cloudscraper가 자동으로 알맞게 생성해주므로 제거하고 Accept만 남깁니다.
-    headers = {
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-    }
-    
+class HttpCache:
+    """ETag/Last-Modified 기반 조건부 GET 캐시.
+
+    cache_dir/index.json에 url -> {etag, lastModified, sha} 를 저장하고,
+    HTML 본문은 cache_dir/<sha>.html.gz 로 보관합니다.
+    before 커서 URL은 실행마다 바뀌므로, 저장할 때 이번 크롤에서 요청한 URL만 남깁니다.
+    """
+
+    INDEX_NAME = "index.json"
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.entries: dict[str, dict] = {}
+        self.requested_urls: set[str] = set()
+        index_path = os.path.join(cache_dir, self.INDEX_NAME)
+        if not os.path.exists(index_path):
+            return
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                self.entries = entries
+        except Exception as e:
+            print(f"[http_cache] failed_to_read_index path={index_path} error={e}")
+
+    def _html_path(self, sha: str) -> str:
+        return os.path.join(self.cache_dir, f"{sha}.html.gz")
+
+    def conditional_headers(self, url: str) -> dict[str, str]:
+        self.requested_urls.add(url)
+        entry = self.entries.get(url)
+        if not entry:
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("lastModified"):
+            headers["If-Modified-Since"] = entry["lastModified"]
+        return headers
+
+    def load_html(self, url: str) -> str | None:
+        entry = self.entries.get(url)
+        if not entry:
+            return None
+        try:
+            with gzip.open(self._html_path(entry["sha"]), "rt", encoding="utf-8") as f:
+                return f.read()
+        except Exception as e:
+            print(f"[http_cache] failed_to_read_html url={url} error={e}")
+            # 본문이 없으면 다음 요청은 조건 없이 보내도록 항목을 지웁니다.
+            self.entries.pop(url, None)
+            return None
+
+    def store(self, url: str, html: str, headers) -> None:
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified:
+            self.entries.pop(url, None)
+            return
+        sha = hashlib.sha256(html.encode("utf-8")).hexdigest()
+        path = self._html_path(sha)
+        if not os.path.exists(path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with gzip.open(path, "wt", encoding="utf-8") as f:
+                f.write(html)
+        self.entries[url] = {"etag": etag, "lastModified": last_modified, "sha": sha}
+
+    def save(self) -> None:
+        # 아무 요청도 하지 못한 실행(차단 등)에서는 기존 캐시를 그대로 둡니다.
+        if self.requested_urls:
+            self.entries = {
+                url: entry
+                for url, entry in self.entries.items()
+                if url in self.requested_urls
+            }
+        if not self.entries and not os.path.isdir(self.cache_dir):
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        index_path = os.path.join(self.cache_dir, self.INDEX_NAME)
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, index_path)
+        # 더 이상 참조되지 않는 HTML 본문은 정리합니다.
+        live = {f"{entry['sha']}.html.gz" for entry in self.entries.values()}
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".html.gz") and name not in live:
+                os.remove(os.path.join(self.cache_dir, name))
+
+
+def fetch_html(
+    url: str,
+    *,
+    http_cache: HttpCache | None = None,
+    max_attempts: int = 3,
+    retry_delay: float = 1.0,
+) -> str | None:
     for attempt in range(1, max_attempts + 1):
         try:
-            # requests.get 대신 scraper.get 사용
-            r = scraper.get(url, headers=headers, timeout=15)
-            if r.status_code != 200:
+            headers = http_cache.conditional_headers(url) if http_cache else None
+            # requests.get 대신 모듈 공용 세션 사용
+            r = _SESSION.get(url, headers=headers, timeout=15)
+            if r.status_code == 304 and http_cache is not None:
+                html = http_cache.load_html(url)
+                if html is not None:
+                    return html
                 print(
-                    f"[fetch_html] status={r.status_code} attempt={attempt}/{max_attempts} url={url}"
+                    f"[fetch_html] not_modified_without_cached_html attempt={attempt}/{max_attempts} url={url}"
                 )
-            elif looks_like_block_page(r.text):
+            elif r.status_code != 200:
                 print(
-                    f"[fetch_html] blocked_page_detected attempt={attempt}/{max_attempts} url={url}"
+                    f"[fetch_html] status={r.status_code} attempt={attempt}/{max_attempts} url={url}"
                 )
             else:
-                return r.text
+                # RoyaleAPI는 UTF-8로 응답하므로 r.text의 charset 추정을 건너뛰고 바로 디코딩합니다.
+                html = r.content.decode("utf-8", "replace")
+                if looks_like_block_page(html):
+                    print(
+                        f"[fetch_html] blocked_page_detected attempt={attempt}/{max_attempts} url={url}"
+                    )
+                else:
+                    if http_cache is not None:
+                        http_cache.store(url, html, r.headers)
+                    return html
         except Exception as e:
             print(
                 f"[fetch_html] exception attempt={attempt}/{max_attempts} url={url} error={e}"
@@ -85,6 +219,15 @@ def fetch_html(url: str, *, max_attempts: int = 3, retry_delay: float = 1.0) ->
     return None
 
 
+def fetch_html_at(
+    url: str, start_at: float, cancelled: threading.Event, **kwargs
+) -> str | None:
+    # start_at(time.monotonic 기준)까지 기다렸다가 요청합니다. 그 전에 크롤이 끝나면 요청하지 않습니다.
+    if cancelled.wait(max(0.0, start_at - time.monotonic())):
+        return None
+    return fetch_html(url, **kwargs)
+
+
 def load_existing_payload(path: str) -> dict | None:
     if not os.path.exists(path):
         return None
@@ -98,6 +241,22 @@ def load_existing_payload(path: str) -> dict | None:
     return None
 
 
+def dump_payload(path: str, payload: dict) -> None:
+    # 한 번에 bytes로 인코딩한 뒤 단일 write + fsync로 기록합니다(os.replace 전에 내용이 디스크에 남도록).
+    if orjson is not None:
+        buf = orjson.dumps(payload, option=orjson.OPT_INDENT_2)
+    else:
+        buf = json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(buf)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def count_payload_matches(payload: dict | None) -> int:
     if not payload or not isinstance(payload, dict):
         return 0
@@ -118,18 +277,18 @@ def resolve_empty_exit_code(mode: str, existing_total: int) -> int:
     return 2
 
 
-def extract_next_before(soup: BeautifulSoup) -> int | None:
+def extract_next_before(tree: LexborHTMLParser, html: str) -> int | None:
     # try any link containing before=
-    for a in soup.select("a[href*='before=']"):
-        href = a.get("href") or ""
+    for a in tree.css("a[href*='before=']"):
+        href = a.attributes.get("href") or ""
         qs = parse_qs(urlparse(href).query)
         if "before" in qs:
             try:
                 return int(qs["before"][0])
             except Exception:
                 continue
-    # fallback: regex search
-    m = re.search(r"before=(\d+)", str(soup))
+    # fallback: regex search (트리를 다시 직렬화하지 않고 원본 HTML에서 찾습니다)
+    m = _BEFORE_RE.search(html)
     if m:
         try:
             return int(m.group(1))
@@ -138,84 +297,150 @@ def extract_next_before(soup: BeautifulSoup) -> int | None:
     return None
 
 
-def parse_deck_keys_from_imgs(imgs) -> list[str]:
-    keys = []
-    for img in imgs:
-        key = (img.get("data-card-key") or "").strip()
-        if not key:
+def card_id(key: str) -> int:
+    cid = _CARD_IDS.get(key)
+    if cid is None:
+        cid = _CARD_IDS[key] = len(_CARD_KEYS)
+        _CARD_KEYS.append(key)
+    return cid
+
+
+def card_keys(ids) -> list[str]:
+    return [_CARD_KEYS[cid] for cid in ids]
+
+
+def parse_deck_keys_from_imgs(imgs) -> array:
+    keys = [(img.attributes.get("data-card-key") or "").strip() for img in imgs]
+    if not all(keys):
+        for i, key in enumerate(keys):
+            if key:
+                continue
             # fallback: attempt from img src
-            src = (img.get("src") or "").strip()
-            m = re.search(r"/cards/([a-z0-9\-]+)/", src)
+            src = (imgs[i].attributes.get("src") or "").strip()
+            m = _CARD_SRC_RE.search(src)
             if m:
-                key = m.group(1)
-        if key:
-            keys.append(key)
-    return keys
+                keys[i] = m.group(1)
+    return array("H", [card_id(key) for key in keys if key])
 
 
-def _parse_deck_from_segment(seg) -> list[str]:
-    imgs = seg.select(CARD_IMG_SELECTOR)
+def _parse_deck_from_segment(seg) -> array:
+    imgs = seg.css(CARD_IMG_SELECTOR)
     return parse_deck_keys_from_imgs(imgs)
 
 
-def parse_matches_from_battle_el(el) -> list[dict]:
+def parse_matches_from_battle_el(el, imgs=None) -> list[Match]:
     # 1) 팀 세그먼트 기반(왼쪽=승리, 오른쪽=패배)
     team_segments = []
     for sel in TEAM_SELECTORS:
-        team_segments.extend(el.select(sel))
+        # lexbor의 node.css()는 노드 자신도 매칭하므로 배틀 요소 자체는 제외합니다.
+        team_segments.extend(seg for seg in el.css(sel) if seg != el)
 
     if len(team_segments) >= 2:
         winner = _parse_deck_from_segment(team_segments[0])
         loser = _parse_deck_from_segment(team_segments[1])
         if len(winner) >= 8 and len(loser) >= 8:
-            return [{"winner": winner[:8], "loser": loser[:8]}]
+            return [(winner[:8], loser[:8])]
 
     # 2) fallback: 카드 이미지를 순서대로 8/8로 자름
-    imgs = el.select(CARD_IMG_SELECTOR)
+    if imgs is None:
+        imgs = el.css(CARD_IMG_SELECTOR)
     keys = parse_deck_keys_from_imgs(imgs)
     if len(keys) < 16:
         return []
-    keys = keys[:16]
-    return [{"winner": keys[:8], "loser": keys[8:16]}]
-
+    return [(keys[:8], keys[8:16])]
 
-def parse_matches(html: str) -> list[dict]:
-    soup = BeautifulSoup(html, "html.parser")
 
+def parse_matches_from_tree(tree: LexborHTMLParser) -> list[Match]:
     battle_els = []
     for sel in BATTLE_SELECTORS:
-        battle_els.extend(soup.select(sel))
+        battle_els.extend(tree.css(sel))
 
     matches = []
     if battle_els:
         for el in battle_els:
             # require at least 16 card images
-            if len(el.select(CARD_IMG_SELECTOR)) < 16:
+            imgs = el.css(CARD_IMG_SELECTOR)
+            if len(imgs) < 16:
                 continue
-            matches.extend(parse_matches_from_battle_el(el))
+            matches.extend(parse_matches_from_battle_el(el, imgs))
     else:
         # fallback: chunk all card images in page
-        imgs = soup.select(CARD_IMG_SELECTOR)
+        imgs = tree.css(CARD_IMG_SELECTOR)
         keys = parse_deck_keys_from_imgs(imgs)
         # group by 16
         for i in range(0, len(keys) - 15, 16):
             chunk = keys[i : i + 16]
             if len(chunk) < 16:
                 break
-            matches.append({"winner": chunk[:8], "loser": chunk[8:16]})
+            matches.append((chunk[:8], chunk[8:16]))
 
     return matches
 
 
-def card_counts(matches: list[dict]) -> dict[str, int]:
-    counts: dict[str, int] = {}
-    for m in matches:
-        for side in ("winner", "loser"):
-            for k in m.get(side, []):
-                if not k:
-                    continue
-                counts[k] = counts.get(k, 0) + 1
-    return counts
+def card_counts(winners: list[array], losers: list[array]) -> dict[str, int]:
+    counts: Counter[int] = Counter(chain.from_iterable(winners))
+    counts.update(chain.from_iterable(losers))
+    return {_CARD_KEYS[cid]: n for cid, n in counts.items()}
+
+
+def crawl_matches(
+    *,
+    rank: int,
+    lang: str,
+    limit: int,
+    delay: float,
+    http_cache: HttpCache | None = None,
+) -> tuple[list[array], list[array]]:
+    # 매치마다 dict를 만들지 않고 승리/패배 덱을 각각의 리스트(SoA)로 모읍니다.
+    winners: list[array] = []
+    losers: list[array] = []
+    before = None
+    # 이미 요청한 before 커서. 페이지네이션이 순환하면 다시 요청하지 않고 멈춥니다.
+    seen_before: set[int] = set()
+
+    # before 커서는 이전 페이지를 파싱해야 알 수 있으므로, 다음 페이지 1개만 미리 요청해 두고
+    # 그동안 현재 페이지의 매치를 파싱합니다.
+    crawl_done = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        try:
+            url = build_url(rank=rank, lang=lang, before=before)
+            pending = pool.submit(fetch_html, url, http_cache=http_cache)
+            while len(winners) < limit:
+                html = pending.result()
+                next_fetch_at = time.monotonic() + delay
+                if not html:
+                    print(f"[crawl] stop:no_html url={url}")
+                    break
+                tree = LexborHTMLParser(html)
+                next_before = extract_next_before(tree, html)
+                has_next = bool(next_before) and next_before not in seen_before
+                if has_next:
+                    seen_before.add(next_before)
+                    next_url = build_url(rank=rank, lang=lang, before=next_before)
+                    pending = pool.submit(
+                        fetch_html_at,
+                        next_url,
+                        next_fetch_at,
+                        crawl_done,
+                        http_cache=http_cache,
+                    )
+                matches = parse_matches_from_tree(tree)
+                if not matches:
+                    print(f"[crawl] stop:no_matches url={url}")
+                    break
+                for winner, loser in matches:
+                    if len(winners) >= limit:
+                        break
+                    winners.append(winner)
+                    losers.append(loser)
+                if not has_next:
+                    break
+                before = next_before
+                url = next_url
+        finally:
+            crawl_done.set()
+
+    return winners, losers
 
 
 def main() -> int:
@@ -223,8 +448,22 @@ def main() -> int:
     ap.add_argument("--limit", type=int, default=1000)
     ap.add_argument("--rank", type=int, default=1000)
     ap.add_argument("--lang", type=str, default="en")
-    ap.add_argument("--delay", type=float, default=0.35)
+    ap.add_argument(
+        "--delay",
+        type=float,
+        default=0.35,
+        help="Seconds to wait after a page arrives before requesting the next one.",
+    )
     ap.add_argument("--out", type=str, default="royaleapi_ranked_cache.json")
+    ap.add_argument(
+        "--http-cache-dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory for ETag/Last-Modified conditional GET cache "
+            "(default: <out without extension>.http, empty string disables)."
+        ),
+    )
     ap.add_argument(
         "--empty-exit-mode",
         choices=("fail", "success-if-existing", "success"),
@@ -254,35 +493,30 @@ def main() -> int:
     elif args.allow_empty_success:
         args.empty_exit_mode = "success"
 
-    results: list[dict] = []
-    before = None
     existing_payload = load_existing_payload(args.out)
     existing_total = count_payload_matches(existing_payload)
     if existing_total > 0:
         print(f"[cache] existing_matches={existing_total} path={args.out}")
 
-    while len(results) < args.limit:
-        url = build_url(rank=args.rank, lang=args.lang, before=before)
-        html = fetch_html(url)
-        if not html:
-            print(f"[crawl] stop:no_html url={url}")
-            break
-        matches = parse_matches(html)
-        if not matches:
-            print(f"[crawl] stop:no_matches url={url}")
-            break
-        for m in matches:
-            if len(results) >= args.limit:
-                break
-            results.append(m)
-        next_before = extract_next_before(BeautifulSoup(html, "html.parser"))
-        if not next_before or next_before == before:
-            break
-        before = next_before
-        time.sleep(args.delay)
-
-    counts = card_counts(results)
-    total_matches = len(results)
+    if args.http_cache_dir is None:
+        args.http_cache_dir = f"{os.path.splitext(args.out)[0]}.http"
+    http_cache = HttpCache(args.http_cache_dir) if args.http_cache_dir else None
+
+    winners, losers = crawl_matches(
+        rank=args.rank,
+        lang=args.lang,
+        limit=args.limit,
+        delay=args.delay,
+        http_cache=http_cache,
+    )
+    if http_cache is not None:
+        try:
+            http_cache.save()
+        except Exception as e:
+            print(f"[http_cache] failed_to_save dir={http_cache.cache_dir} error={e}")
+
+    counts = card_counts(winners, losers)
+    total_matches = len(winners)
     if total_matches == 0:
         print("[result] fetched_matches=0, keeping existing cache unchanged")
         if existing_total > 0:
@@ -293,7 +527,7 @@ def main() -> int:
         print(f"[result] empty_exit_mode={args.empty_exit_mode} exit_code={exit_code}")
         return exit_code
 
-    top_cards = sorted(counts.items(), key=lambda x: (-x[1], x[0]))[:3]
+    top_cards = heapq.nsmallest(3, counts.items(), key=lambda x: (-x[1], x[0]))
     top_cards_out = [
         {
             "key": k,
@@ -310,15 +544,17 @@ def main() -> int:
         "limit": args.limit,
         "totalMatches": total_matches,
         "topCards": top_cards_out,
-        "matches": results,
+        "matches": [
+            {"winner": card_keys(winner), "loser": card_keys(loser)}
+            for winner, loser in zip(winners, losers)
+        ],
     }
 
     out_dir = os.path.dirname(os.path.abspath(args.out))
     if out_dir:
         os.makedirs(out_dir, exist_ok=True)
     tmp_out = f"{args.out}.tmp"
-    with open(tmp_out, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=2)
+    dump_payload(tmp_out, payload)
     os.replace(tmp_out, args.out)
     print(f"[result] wrote_matches={total_matches} path={args.out}")
 
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+import royaleapi_ranked_cache as cache
+
+
+class HttpCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, "cache.http")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        c = cache.HttpCache(self.cache_dir)
+        c.conditional_headers("u")
+        c.store("u", "<p>ü</p>", {"ETag": '"x"'})
+        c.save()
+
+        c = cache.HttpCache(self.cache_dir)
+        self.assertEqual(c.conditional_headers("u"), {"If-None-Match": '"x"'})
+        self.assertEqual(c.load_html("u"), "<p>ü</p>")
+
+    def test_save_drops_urls_not_requested_this_crawl(self):
+        c = cache.HttpCache(self.cache_dir)
+        for url in ("old", "kept"):
+            c.conditional_headers(url)
+            c.store(url, f"<p>{url}</p>", {"ETag": url})
+        c.save()
+
+        c = cache.HttpCache(self.cache_dir)
+        c.conditional_headers("kept")
+        c.save()
+
+        c = cache.HttpCache(self.cache_dir)
+        self.assertEqual(list(c.entries), ["kept"])
+        bodies = [n for n in os.listdir(self.cache_dir) if n.endswith(".html.gz")]
+        self.assertEqual(len(bodies), 1)
+
+    def test_save_without_requests_keeps_index(self):
+        c = cache.HttpCache(self.cache_dir)
+        c.conditional_headers("u")
+        c.store("u", "<p>u</p>", {"ETag": "u"})
+        c.save()
+
+        cache.HttpCache(self.cache_dir).save()
+        self.assertEqual(list(cache.HttpCache(self.cache_dir).entries), ["u"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+from pathlib import Path
+
+from selectolax.lexbor import LexborHTMLParser
+
+import royaleapi_ranked_cache as cache
+
+FIXTURE = Path(__file__).parent / "fixtures" / "ranked_page.html"
+
+
+class ParseMatchesTest(unittest.TestCase):
+    def setUp(self):
+        self.html = FIXTURE.read_text(encoding="utf-8")
+        self.tree = LexborHTMLParser(self.html)
+
+    def test_decks_are_parsed_once_per_card(self):
+        matches = cache.parse_matches_from_tree(self.tree)
+        decks = [(cache.card_keys(w), cache.card_keys(l)) for w, l in matches]
+        self.assertEqual(
+            decks[0],
+            ([f"w{i}" for i in range(8)], [f"l{i}" for i in range(8)]),
+        )
+
+    def test_battle_element_is_not_its_own_team_segment(self):
+        matches = cache.parse_matches_from_tree(self.tree)
+        decks = [(cache.card_keys(w), cache.card_keys(l)) for w, l in matches]
+        self.assertEqual(
+            decks[1],
+            ([f"a{i}" for i in range(8)], [f"b{i}" for i in range(8)]),
+        )
+
+    def test_card_counts(self):
+        matches = cache.parse_matches_from_tree(self.tree)
+        counts = cache.card_counts([w for w, _ in matches], [l for _, l in matches])
+        self.assertEqual(counts["w0"], 1)
+        self.assertEqual(counts["l7"], 1)
+
+    def test_extract_next_before(self):
+        self.assertEqual(cache.extract_next_before(self.tree, self.html), 1711843200000)
+
+
+if __name__ == "__main__":
+    unittest.main()